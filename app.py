@@ -1,19 +1,11 @@
-from flask import Flask, render_template, request, jsonify,redirect,url_for, flash
+from flask import Flask, render_template, request, jsonify,redirect,url_for, flash, session, make_response, g
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import bindparam, event, func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import load_only
 from datetime import datetime,date,time
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import io
-import base64
-import os
-import matplotlib
-
-matplotlib.rcParams['font.sans-serif'] = ['SimHei', 'Microsoft YaHei', 'DejaVu Sans']
-matplotlib.rcParams['axes.unicode_minus'] = False
-
-
 import os
+import sqlite3
 
 app = Flask(__name__)
 
@@ -38,6 +30,20 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 db = SQLAlchemy(app)
 
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragma(dbapi_connection, connection_record):
+    """SQLite连接参数：WAL模式下读写互不阻塞，并减少每次提交的fsync"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return  # MySQL等其他数据库不处理
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA cache_size=-20000')  # 约20MB页缓存
+    cursor.close()
+
 # ========== 数据模型 ==========
 class UserConfig(db.Model):
     """用户配置表"""
@@ -60,18 +66,55 @@ class FoodTemplate(db.Model):
 
 class DailyRecord(db.Model):
     """每日饮食记录表"""
+    __table_args__ = (
+        db.Index('ix_daily_date_time', 'date', 'time'),  # 按日期查询并按时间排序
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.Date, nullable=False, default=lambda: datetime.utcnow().date)
-    time = db.Column(db.Time, nullable=False, default=lambda: datetime.utcnow().time)
+    # 默认值使用本地日期时间，与查询用的date.today()一致
+    date = db.Column(db.Date, nullable=False, default=date.today)
+    time = db.Column(db.Time, nullable=False, default=lambda: datetime.now().time())
     food_name = db.Column(db.String(100), nullable=False)  # 食物名称
     weight = db.Column(db.Float, nullable=False)  # 重量(g)
     carb_ratio = db.Column(db.Float, nullable=False)  # 碳水比例(百分比)
     protein_ratio = db.Column(db.Float, nullable=False)  # 蛋白质比例(百分比)
     fat_ratio = db.Column(db.Float, nullable=False)  # 脂肪比例(百分比)
     notes = db.Column(db.Text)  # 备注
-    template_id = db.Column(db.Integer, db.ForeignKey('food_template.id'))  # 关联模板
+    template_id = db.Column(db.Integer, db.ForeignKey('food_template.id'), index=True)  # 关联模板
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+class DataVersion(db.Model):
+    """缓存版本表：数据修改时在同一事务中递增，各进程据此判断自己的缓存是否过期"""
+    name = db.Column(db.String(50), primary_key=True)  # 缓存名称
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+# 仪表盘和历史页面列表只用到这些列，不加载notes等字段
+_record_list_columns = load_only(
+    DailyRecord.id, DailyRecord.time, DailyRecord.food_name, DailyRecord.weight,
+    DailyRecord.carb_ratio, DailyRecord.protein_ratio, DailyRecord.fat_ratio
+)
+
+# 每条记录营养素克数的SQL汇总表达式：碳水、蛋白质、脂肪
+_nutrient_sums = (
+    func.sum(DailyRecord.weight * DailyRecord.carb_ratio / 100.0),
+    func.sum(DailyRecord.weight * DailyRecord.protein_ratio / 100.0),
+    func.sum(DailyRecord.weight * DailyRecord.fat_ratio / 100.0)
+)
+
+# 单日汇总语句在模块加载时构建一次，执行时只绑定日期参数 d
+_day_summary_stmt = select(*_nutrient_sums).where(DailyRecord.date == bindparam('d'))
+
+# 进度接口用：一条语句同时取出用户配置的每日目标和当天汇总（用户配置只有一行）
+_progress_stmt = select(
+    UserConfig.weight * UserConfig.carb_per_kg,
+    UserConfig.weight * UserConfig.protein_per_kg,
+    UserConfig.weight * UserConfig.fat_per_kg,
+    *_nutrient_sums
+).select_from(UserConfig) \
+    .outerjoin(DailyRecord, DailyRecord.date == bindparam('d')) \
+    .group_by(UserConfig.id).limit(1)
+
 
 # ========== 核心计算逻辑 ==========
 class NutrientCalculator:
@@ -87,58 +130,66 @@ class NutrientCalculator:
         }
 
     @staticmethod
-    def calculate_nutrient_amount(record):
-        """计算单条记录的营养素含量"""
-        carb_g = record.weight * record.carb_ratio / 100
-        protein_g = record.weight * record.protein_ratio / 100
-        fat_g = record.weight * record.fat_ratio / 100
-        calories = (carb_g * 4) + (protein_g * 4) + (fat_g * 9)  # 计算热量
+    def get_daily_summary(target_date=None):
+        """获取每日摄入汇总"""
+        if target_date is None:
+            target_date = date.today()
+
+        # 在数据库中直接汇总当天的营养素，避免逐条加载记录
+        row = db.session.execute(_day_summary_stmt, {'d': target_date}).one()
+        return NutrientCalculator._summary_from_sums(*row)
+
+    @staticmethod
+    def _summary_from_sums(carb_g, protein_g, fat_g):
+        """由SQL汇总结果构造汇总字典"""
+        # 没有记录时SUM返回NULL
+        carb_g = carb_g or 0
+        protein_g = protein_g or 0
+        fat_g = fat_g or 0
 
         return {
             'carb': carb_g,
             'protein': protein_g,
             'fat': fat_g,
-            'calories': calories
+            'calories': (carb_g * 4) + (protein_g * 4) + (fat_g * 9)
         }
 
     @staticmethod
-    def get_daily_summary(target_date=None):
-        """获取每日摄入汇总"""
-        if target_date is None:
-            target_date = date.today()
-
-        # 获取当天的所有记录
-        records = DailyRecord.query.filter_by(date=target_date).all()
-
-        total = {'carb': 0, 'protein': 0, 'fat': 0, 'calories': 0}
-
+    def get_daily_summary_from_records(records):
+        """根据已查询出的记录计算汇总（页面已加载当天记录时复用，避免重复查询）"""
+        # 直接累加三项克数，不为每条记录构造中间字典；热量由总量统一计算
+        carb_g = protein_g = fat_g = 0
         for record in records:
-            nutrients = NutrientCalculator.calculate_nutrient_amount(record)
-            for key in total:
-                total[key] += nutrients[key]
+            weight = record.weight
+            carb_g += weight * record.carb_ratio / 100
+            protein_g += weight * record.protein_ratio / 100
+            fat_g += weight * record.fat_ratio / 100
 
-        return total
+        return NutrientCalculator._summary_from_sums(carb_g, protein_g, fat_g)
 
     @staticmethod
     def get_progress(user_config, daily_summary):
         """计算进度条数据"""
-        goals = NutrientCalculator.calculate_daily_goals(user_config)
-
-        progress = {}
-        for nutrient in ['carb', 'protein', 'fat']:
-            consumed = daily_summary.get(nutrient, 0)
-            goal = goals.get(nutrient, 1)  # 避免除零
-            percentage = min((consumed / goal) * 100, 100) if goal > 0 else 0
-
-            progress[nutrient] = {
-                'consumed': round(consumed, 1),
-                'goal': round(goal, 1),
-                'percentage': round(percentage, 1),
-                'remaining': max(round(goal - consumed, 1), 0),
-                'is_over': consumed > goal
-            }
+        weight = user_config.weight
+        goals = (weight * user_config.carb_per_kg,
+                 weight * user_config.protein_per_kg,
+                 weight * user_config.fat_per_kg)
+        consumed = (daily_summary['carb'], daily_summary['protein'], daily_summary['fat'])
+        return NutrientCalculator._progress_from_values(goals, consumed)
 
-        return progress
+    @staticmethod
+    def _progress_from_values(goals, consumed):
+        """由碳水、蛋白质、脂肪的目标和摄入量构造进度条数据"""
+        return {
+            nutrient: {
+                'consumed': round(c, 1),
+                'goal': round(g, 1),
+                'percentage': round(min(c / g * 100, 100), 1) if g > 0 else 0,  # 避免除零
+                'remaining': max(round(g - c, 1), 0),
+                'is_over': c > g
+            }
+            for nutrient, c, g in zip(('carb', 'protein', 'fat'), consumed, goals)
+        }
 
 
 # ========== 初始化数据库 ==========
@@ -147,6 +198,16 @@ def init_database():
     with app.app_context():
         db.create_all()
 
+        # create_all不会给已存在的表补建索引，这里单独检查创建
+        for idx in DailyRecord.__table__.indexes:
+            idx.create(bind=db.engine, checkfirst=True)
+
+        # 补齐缓存版本记录（旧数据库没有这张表）
+        for name in _cached_data_names:
+            if db.session.get(DataVersion, name) is None:
+                db.session.add(DataVersion(name=name, version=0))
+        db.session.commit()
+
         # 如果没有用户配置，创建默认配置
         if UserConfig.query.first() is None:
             default_config = UserConfig(
@@ -159,49 +220,118 @@ def init_database():
 
             # 添加一些示例模板
             sample_templates = [
-                FoodTemplate(name="白米饭", carb_ratio=75, protein_ratio=7, fat_ratio=1),
-                FoodTemplate(name="鸡胸肉", carb_ratio=0, protein_ratio=23, fat_ratio=2),
-                FoodTemplate(name="鸡蛋", carb_ratio=1, protein_ratio=13, fat_ratio=11),
-                FoodTemplate(name="炒饭", carb_ratio=40, protein_ratio=20, fat_ratio=10),
+                {'name': "白米饭", 'carb_ratio': 75, 'protein_ratio': 7, 'fat_ratio': 1},
+                {'name': "鸡胸肉", 'carb_ratio': 0, 'protein_ratio': 23, 'fat_ratio': 2},
+                {'name': "鸡蛋", 'carb_ratio': 1, 'protein_ratio': 13, 'fat_ratio': 11},
+                {'name': "炒饭", 'carb_ratio': 40, 'protein_ratio': 20, 'fat_ratio': 10},
             ]
 
-            for template in sample_templates:
-                db.session.add(template)
+            # 批量插入，不逐个走ORM的unit-of-work
+            db.session.bulk_insert_mappings(FoodTemplate, sample_templates)
 
             db.session.commit()
             print("数据库初始化完成！")
 
 
+# ========== 数据缓存 ==========
+# 缓存放在各进程内，是否过期由数据库中的共享版本号（DataVersion）判断，
+# 这样多个worker进程之间也能感知其他进程的修改
+_cached_data_names = ('user_config', 'templates')
+
+
+def _data_versions():
+    """读取所有缓存的共享版本号，每个请求只查询一次"""
+    if 'data_versions' not in g:
+        g.data_versions = dict(db.session.query(DataVersion.name, DataVersion.version).all())
+    return g.data_versions
+
+
+def _bump_data_version(name):
+    """在当前事务中递增版本号，需在提交数据修改之前调用"""
+    updated = DataVersion.query.filter_by(name=name) \
+        .update({DataVersion.version: DataVersion.version + 1})
+    if not updated:
+        db.session.add(DataVersion(name=name, version=1))
+    g.pop('data_versions', None)
+
+
+# 用户配置只会通过 /config 修改，缓存值为 (版本号, 配置)
+_user_config_cache = {'v': None}
+
+
+def get_user_config():
+    """获取用户配置（带缓存）"""
+    # 先读版本号再查数据，查到的数据不会比版本号旧
+    version = _data_versions().get('user_config', 0)
+    cached = _user_config_cache['v']
+    if cached is None or cached[0] != version:
+        user_config = UserConfig.query.first()
+        if user_config is not None:
+            # 脱离session，避免请求结束或其他提交使已加载的属性过期
+            db.session.expunge(user_config)
+        cached = _user_config_cache['v'] = (version, user_config)
+    return cached[1]
+
+
+def invalidate_user_config():
+    """用户配置修改后使所有进程的缓存失效，需在commit之前调用"""
+    _bump_data_version('user_config')
+
+
+# 食物模板只会通过添加/编辑/删除修改，缓存值为 (版本号, 模板列表)
+_tpl_cache = {'v': None}
+
+
+def get_templates_version():
+    """食物模板的共享版本号，也用作 /templates 页面的ETag"""
+    return _data_versions().get('templates', 0)
+
+
+def get_templates():
+    """获取按名称排序的食物模板列表（带缓存）"""
+    # 先读版本号再查数据，查到的列表不会比版本号旧
+    version = get_templates_version()
+    cached = _tpl_cache['v']
+    if cached is None or cached[0] != version:
+        templates = FoodTemplate.query.order_by(FoodTemplate.name).all()
+        for template in templates:
+            db.session.expunge(template)
+        cached = _tpl_cache['v'] = (version, templates)
+    return cached[1]
+
+
+def invalidate_templates():
+    """模板修改后使所有进程的缓存失效，需在commit之前调用"""
+    _bump_data_version('templates')
+
+
 # ========== 路由和视图函数 ==========
 @app.route('/')
 def index():
     """首页/仪表盘"""
     # 获取用户配置
-    user_config = UserConfig.query.first()
+    user_config = get_user_config()
 
-    # 获取今日汇总
+    # 获取今日记录
     today = date.today()
-    daily_summary = NutrientCalculator.get_daily_summary(today)
+    today_records = DailyRecord.query.options(_record_list_columns) \
+        .filter_by(date=today).order_by(DailyRecord.time).all()
+
+    # 获取今日汇总（复用已加载的记录）
+    daily_summary = NutrientCalculator.get_daily_summary_from_records(today_records)
 
     # 计算进度
     progress = NutrientCalculator.get_progress(user_config, daily_summary)
 
-    # 获取今日记录
-    today_records = DailyRecord.query.filter_by(date=today).order_by(DailyRecord.time).all()
-
     # 获取食物模板
-    templates = FoodTemplate.query.order_by(FoodTemplate.name).all()
-
-    # 生成图表
-    chart_url = generate_progress_chart(progress)
+    templates = get_templates()
 
     return render_template('dashboard.html',
                            user_config=user_config,
                            progress=progress,
                            records=today_records,
                            templates=templates,
-                           today=today,
-                           chart_url=chart_url)
+                           today=today)
 
 
 @app.route('/config', methods=['GET', 'POST'])
@@ -216,6 +346,7 @@ def config():
             user_config.protein_per_kg = float(request.form['protein_per_kg'])
             user_config.fat_per_kg = float(request.form['fat_per_kg'])
             user_config.updated_at = datetime.utcnow()
+            invalidate_user_config()
 
             db.session.commit()
             flash('配置已更新！', 'success')
@@ -229,7 +360,7 @@ def config():
 @app.route('/add_record', methods=['GET', 'POST'])
 def add_record():
     """添加饮食记录"""
-    templates = FoodTemplate.query.order_by(FoodTemplate.name).all()
+    templates = get_templates()
 
     if request.method == 'POST':
         try:
@@ -265,7 +396,7 @@ def add_record():
 
             # 解析时间
             time_str = request.form.get('time', datetime.now().strftime('%H:%M'))
-            record_time = datetime.strptime(time_str, '%H:%M').time()
+            record_time = parse_time(time_str)
 
             # 创建记录
             record = DailyRecord(
@@ -318,6 +449,7 @@ def add_template():
                 template.calories = float(request.form['calories'])
 
             db.session.add(template)
+            invalidate_templates()
             db.session.commit()
             flash('模板添加成功！', 'success')
             return redirect(url_for('templates'))
@@ -332,8 +464,20 @@ def add_template():
 @app.route('/templates')
 def templates():
     """查看所有模板"""
-    templates = FoodTemplate.query.order_by(FoodTemplate.name).all()
-    return render_template('templates.html', templates=templates)
+    etag = f"tpl-{get_templates_version()}"
+
+    # 有待显示的提示消息时必须重新渲染页面
+    if '_flashes' not in session and request.if_none_match.contains(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response
+
+    templates = get_templates()
+    response = make_response(render_template('templates.html', templates=templates))
+    response.set_etag(etag)
+    response.cache_control.no_cache = True  # 浏览器每次都向服务器验证ETag
+    return response
 
 
 @app.route('/history')
@@ -343,20 +487,21 @@ def history():
     selected_date = request.args.get('date')
     if selected_date:
         try:
-            target_date = datetime.strptime(selected_date, '%Y-%m-%d').date()
+            target_date = parse_date(selected_date)
         except ValueError:
             target_date = date.today()
     else:
         target_date = date.today()
 
     # 获取该日期的所有记录
-    records = DailyRecord.query.filter_by(date=target_date).order_by(DailyRecord.time.desc()).all()
+    records = DailyRecord.query.options(_record_list_columns) \
+        .filter_by(date=target_date).order_by(DailyRecord.time.desc()).all()
 
-    # 计算每日汇总
-    daily_summary = NutrientCalculator.get_daily_summary(target_date)
+    # 计算每日汇总（复用已加载的记录）
+    daily_summary = NutrientCalculator.get_daily_summary_from_records(records)
 
     # 获取用户配置来计算目标
-    user_config = UserConfig.query.first()
+    user_config = get_user_config()
     goals = NutrientCalculator.calculate_daily_goals(user_config)
 
     return render_template('history.html',
@@ -369,9 +514,11 @@ def history():
 @app.route('/api/progress')
 def api_progress():
     """API: 获取进度数据（用于AJAX更新）"""
-    user_config = UserConfig.query.first()
-    daily_summary = NutrientCalculator.get_daily_summary()
-    progress = NutrientCalculator.get_progress(user_config, daily_summary)
+    row = db.session.execute(_progress_stmt, {'d': date.today()}).one()
+
+    # 前三列为目标，后三列为摄入量（当天没有记录时SUM返回NULL）
+    consumed = tuple(value or 0 for value in row[3:])
+    progress = NutrientCalculator._progress_from_values(row[:3], consumed)
 
     return jsonify(progress)
 
@@ -391,6 +538,7 @@ def delete_template(id):
     """删除模板"""
     template = FoodTemplate.query.get_or_404(id)
     db.session.delete(template)
+    invalidate_templates()
     db.session.commit()
     flash('模板已删除！', 'success')
     return redirect(url_for('templates'))
@@ -411,6 +559,7 @@ def edit_template(id):
             if request.form.get('calories'):
                 template.calories = float(request.form['calories'])
 
+            invalidate_templates()
             db.session.commit()
             flash('模板已更新！', 'success')
             return redirect(url_for('templates'))
@@ -421,73 +570,35 @@ def edit_template(id):
 
 
 # ========== 辅助函数 ==========
-def generate_progress_chart(progress):
-    """生成进度条图表"""
-    try:
-        # 尝试设置中文字体
-        import matplotlib.font_manager as fm
-
-        # 查找字体文件
-        font_paths = [
-            '/home/BangrunHe/DietaryRecord/static/fonts/SimHei.ttf',
-            '/home/BangrunHe/DietaryRecord/static/fonts/msyh.ttf',
-            '/usr/share/fonts/truetype/wqy/wqy-microhei.ttc',  # 系统可能有的中文字体
-        ]
-
-        for font_path in font_paths:
-            if os.path.exists(font_path):
-                fm.fontManager.addfont(font_path)
-                font_name = fm.FontProperties(fname=font_path).get_name()
-                plt.rcParams['font.sans-serif'] = [font_name]
-                plt.rcParams['axes.unicode_minus'] = False
-                print(f"使用字体: {font_name}")
-                break
-        else:
-            # 没找到中文字体，使用英文
-            print("未找到中文字体，使用英文标签")
-            labels = ['Carb', 'Protein', 'Fat']
-            
-        # 准备数据
-        labels = ['碳水', '蛋白质', '脂肪']
-        percentages = [progress['carb']['percentage'],
-                       progress['protein']['percentage'],
-                       progress['fat']['percentage']]
-
-        # 设置颜色：超标显示红色，未超标显示绿色
-        colors = []
-        for nutrient in ['carb', 'protein', 'fat']:
-            if progress[nutrient]['is_over']:
-                colors.append('#FF6B6B')  # 红色
-            else:
-                colors.append('#4ECDC4')  # 青色
-
-        # 创建图表
-        fig, ax = plt.subplots(figsize=(10, 4))
-        bars = ax.bar(labels, percentages, color=colors)
-
-        # 设置图表属性
-        ax.set_ylim(0, 110)
-        ax.set_ylabel('完成度 (%)')
-        ax.set_title('今日营养素摄入进度')
-        ax.axhline(y=100, color='red', linestyle='--', alpha=0.5)  # 100%参考线
-
-        # 在每个柱子上添加数值标签
-        for bar, percentage in zip(bars, percentages):
-            height = bar.get_height()
-            ax.text(bar.get_x() + bar.get_width() / 2., height + 2,
-                    f'{percentage:.1f}%', ha='center', va='bottom', fontsize=10)
-
-        # 转换为base64图像
-        img = io.BytesIO()
-        plt.tight_layout()
-        plt.savefig(img, format='png', dpi=80, bbox_inches='tight')
-        plt.close()
-        img.seek(0)
-
-        return base64.b64encode(img.getvalue()).decode('utf-8')
-    except Exception as e:
-        print(f"生成图表失败: {e}")
-        return None
+def parse_time(time_str):
+    """解析 HH:MM 格式的时间，格式不符时抛出ValueError"""
+    # 表单提交的标准格式直接按位置取值，避免strptime的开销
+    if len(time_str) == 5 and time_str[2] == ':' and time_str[:2].isdigit() and time_str[3:].isdigit():
+        return time(int(time_str[:2]), int(time_str[3:]))
+    return datetime.strptime(time_str, '%H:%M').time()
+
+
+def parse_date(date_str):
+    """解析 YYYY-MM-DD 格式的日期，格式不符时抛出ValueError"""
+    if (len(date_str) == 10 and date_str[4] == '-' and date_str[7] == '-'
+            and date_str[:4].isdigit() and date_str[5:7].isdigit() and date_str[8:].isdigit()):
+        return date(int(date_str[:4]), int(date_str[5:7]), int(date_str[8:]))
+    return datetime.strptime(date_str, '%Y-%m-%d').date()
+
+
+def bulk_add_records(rows, batch_size=1000):
+    """批量添加饮食记录（用于导入等场景），rows为字段字典列表，未给出date/time时使用当前本地日期和时间"""
+    # executemany要求每行的字段一致，这里把所有可选字段都补齐
+    now = datetime.now()
+    defaults = {'date': now.date(), 'time': now.time(), 'notes': None,
+                'template_id': None, 'created_at': datetime.utcnow()}
+    rows = [{**defaults, **row} for row in rows]
+
+    # 每batch_size条执行一次executemany，全部在同一事务中提交
+    insert_stmt = DailyRecord.__table__.insert()
+    for start in range(0, len(rows), batch_size):
+        db.session.execute(insert_stmt, rows[start:start + batch_size])
+    db.session.commit()
 
 
 # ========== 启动应用 ==========